@@ -8,6 +8,7 @@ from ScaleImage import scale_image  # Import the scaling function
 import bicubic_upsample
 import wavelet_haar_transform  # Import Haar transform functions
 import colourize
+import segmentation
 
 
 class ImageProcessing:
@@ -49,8 +50,8 @@ class ImageProcessing:
         self.scale_button = tk.Button(self.ctrl_frame, text="Scale Image", command=self.scale_image_button_clicked)
         self.scale_button.pack(pady=10, padx=10, anchor="n")
 
-        self.add_detail_button = tk.Button(self.ctrl_frame, text="Segmentation", command=self.add_detail_button_clicked)
-        self.add_detail_button.pack(pady=10, padx=10, anchor="n")
+        self.segmentation_button = tk.Button(self.ctrl_frame, text="Segmentation", command=self.segmentation_button_clicked)
+        self.segmentation_button.pack(pady=10, padx=10, anchor="n")
 
         self.process_button = tk.Button(self.ctrl_frame, text="Process Region", command=self.process_selected_region)
         self.process_button.pack(pady=10, padx=10, anchor="n")
@@ -188,19 +189,34 @@ class ImageProcessing:
             print("Save operation canceled.")
 
 
-    def add_detail_button_clicked(self):
+    def segmentation_button_clicked(self):
         """
-        Enhances the image by applying a Haar wavelet transform and then reconstructing it.
+        Segments the selected region, or the whole image if no region is selected,
+        using Otsu thresholding and connected-component labelling, then plots the labelled regions.
         """
         if self.image is not None:
-            image_np = np.array(self.image) / 255.0  # Normalize the image to [0, 1]
-            transformed_image = wavelet_haar_transform.haar_transform_2d(image_np)  # Apply Haar transform
-            reconstructed_image = wavelet_haar_transform.inverse_haar_transform_2d(
-                transformed_image)  # Reconstruct the image
-            reconstructed_image = (reconstructed_image * 255).astype(np.uint8)  #NB! Convert back to [0, 255], otherwise it breaks
+            region = self.crop_selected_region()
+            if region is None or 0 in region.size:  # A click without dragging selects nothing
+                region = self.image
+            image_np = np.array(region.convert('L'))  # Pseudo colored images are back to grayscale
+            label_map = segmentation.segment_image(image_np, method="otsu", min_area=20)
+            self.plot_segmentation(image_np, label_map)
+
+    def plot_segmentation(self, image, label_map):
+        """
+        Plots the segmented image next to its label map.
+        """
+        fig, axes = plt.subplots(1, 2, figsize=(12, 6))
+
+        axes[0].imshow(image, cmap='gray')
+        axes[0].set_title("Original Image")
+        axes[0].axis('off')
 
-            # Plot the original, transformed, and reconstructed images
-            self.plot_images(self.image, transformed_image, reconstructed_image)
+        axes[1].imshow(label_map.labels, cmap='nipy_spectral', interpolation='nearest')
+        axes[1].set_title(f"Segmentation ({label_map.count} regions)")
+        axes[1].axis('off')
+
+        plt.show()
 
     def apply_pseudo_color(self):
         """
@@ -214,28 +230,6 @@ class ImageProcessing:
             self.image = pseudo_color_image  # Update the image with the pseudocolored image
             self.display_image(pseudo_color_image)  # Display the pseudocolored image
 
-    def plot_images(self, original, transformed, reconstructed):
-        """
-        Plots the original, transformed, and reconstructed images side by side.
-        """
-
-        fig, axes = plt.subplots(1, 3, figsize=(18, 6))
-
-        axes[0].imshow(original, cmap='gray')
-        axes[0].set_title("Original Image")
-        axes[0].axis('off')
-
-        axes[1].imshow(transformed, cmap='gray')
-        axes[1].set_title("Haar Transformed Image")
-        axes[1].axis('off')
-
-        axes[2].imshow(reconstructed, cmap='gray')
-        axes[2].set_title("Reconstructed Image")
-        axes[2].axis('off')
-
-        plt.show()
-
-
     def scale_image_button_clicked(self):
         """
         Handles the event when the "Scale Image" button is clicked.
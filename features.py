@@ -0,0 +1,270 @@
+import os
+import json
+import numpy as np
+
+
+def haar_subbands(batch):
+    """
+    One level of the 2D Haar transform on a whole batch of images at once.
+
+    Gives the same subbands as wavelet_haar_transform.haar_transform_2d, where LL is
+    the top-left quarter, LH the top-right, HL the bottom-left and HH the bottom-right.
+    Odd rows and columns are dropped.
+
+    Args:
+        batch: Array of shape (images, rows, cols).
+
+    Returns:
+        LL, LH, HL, HH arrays of shape (images, rows // 2, cols // 2).
+    """
+    rows, cols = batch.shape[1] // 2 * 2, batch.shape[2] // 2 * 2
+    a = batch[:, 0:rows:2, 0:cols:2]
+    b = batch[:, 0:rows:2, 1:cols:2]
+    c = batch[:, 1:rows:2, 0:cols:2]
+    d = batch[:, 1:rows:2, 1:cols:2]
+
+    LL = (a + b + c + d) / 2
+    LH = (a - b + c - d) / 2
+    HL = (a + b - c - d) / 2
+    HH = (a - b - c + d) / 2
+    return LL, LH, HL, HH
+
+
+def feature_names(levels=3):
+    """Names of the columns returned by extract_features, in order."""
+    names = ["mean", "std", "min", "max", "entropy"]
+    for level in range(1, levels + 1):
+        names += [f"LH{level}_energy", f"HL{level}_energy", f"HH{level}_energy"]
+    names.append(f"LL{levels}_energy")
+    return names
+
+
+def extract_features(images, levels=3):
+    """
+    Compute intensity statistics, entropy and Haar subband energies for a batch of slices.
+
+    Every statistic is computed over the whole batch with one array operation, so
+    thousands of slices cost a handful of numpy calls per level.
+
+    Args:
+        images: Array of shape (images, rows, cols), uint8 or floats in [0, 1].
+        levels: Number of Haar decomposition levels, each one splits the previous LL.
+
+    Returns:
+        float32 array of shape (images, len(feature_names(levels))).
+    """
+    images = np.asarray(images)
+    if images.ndim == 2:
+        images = images[None]
+    if images.dtype == np.uint8:
+        gray = images
+        batch = images.astype(np.float32) / 255.0  # Normalize the images to [0, 1]
+    else:
+        batch = images.astype(np.float32)
+        gray = np.round(np.clip(batch, 0.0, 1.0) * 255).astype(np.uint8)
+
+    count = batch.shape[0]
+    flat = batch.reshape(count, -1)
+    columns = [flat.mean(axis=1), flat.std(axis=1), flat.min(axis=1), flat.max(axis=1)]
+
+    # One bincount for the histograms of all the images, each image gets its own 256 bins
+    offsets = np.arange(count, dtype=np.intp)[:, None] * 256
+    counts = np.bincount((gray.reshape(count, -1) + offsets).ravel(), minlength=count * 256)
+    p = counts.reshape(count, 256) / gray[0].size
+    with np.errstate(divide='ignore', invalid='ignore'):
+        columns.append(-np.sum(np.where(p > 0, p * np.log2(p), 0.0), axis=1))
+
+    LL = batch
+    for _ in range(levels):
+        if min(LL.shape[1:]) < 2:
+            raise ValueError(f"Images are too small for {levels} Haar levels")
+        LL, LH, HL, HH = haar_subbands(LL)
+        for band in (LH, HL, HH):
+            columns.append(np.mean(band ** 2, axis=(1, 2)))
+    columns.append(np.mean(LL ** 2, axis=(1, 2)))
+
+    return np.stack(columns, axis=1).astype(np.float32)
+
+
+class FeatureStore:
+    """
+    Columnar on-disk store of slice features.
+
+    Each feature is kept as one contiguous float32 column of a memory-mapped
+    (columns, capacity) array, so reading a single feature for all the slices touches
+    only that column. Slice keys and the column names are kept in a JSON file next to it.
+
+    Attributes:
+        path: Directory holding features.npy and metadata.json.
+        columns: Names of the feature columns.
+        keys: Identifier of every stored slice, e.g. "study/slice".
+        data: Memory-mapped float32 array of shape (columns, capacity).
+    """
+
+    def __init__(self, path, mode='r'):
+        """Open an existing store, mode 'r+' allows appending."""
+        self.path = path
+        with open(os.path.join(path, "metadata.json")) as f:
+            metadata = json.load(f)
+        self.columns = metadata["columns"]
+        self.keys = metadata["keys"]
+        self.mode = mode
+        self.data = np.load(os.path.join(path, "features.npy"), mmap_mode=mode)
+
+    @classmethod
+    def create(cls, path, columns, capacity=1024):
+        """Create an empty store with room for `capacity` slices, it grows when full."""
+        if os.path.exists(os.path.join(path, "metadata.json")):
+            raise FileExistsError(f"A feature store already exists at {path}")
+        os.makedirs(path, exist_ok=True)
+        data = np.lib.format.open_memmap(os.path.join(path, "features.npy"), mode='w+',
+                                         dtype=np.float32, shape=(len(columns), capacity))
+        del data
+        with open(os.path.join(path, "metadata.json"), "w") as f:
+            json.dump({"columns": list(columns), "keys": []}, f)
+        return cls(path, mode='r+')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def append(self, keys, features):
+        """Add the features of a batch of slices, one row of `features` per key."""
+        features = np.asarray(features, dtype=np.float32)
+        if features.shape != (len(keys), len(self.columns)):
+            raise ValueError("Features must have one row per key and one column per feature name")
+
+        start, end = len(self.keys), len(self.keys) + len(keys)
+        if end > self.data.shape[1]:
+            self._grow(max(end, 2 * self.data.shape[1]))
+        self.data[:, start:end] = features.T
+        self.keys.extend(keys)
+        self.flush()
+
+    def _grow(self, capacity):
+        """Copy the store into a larger file, doubling keeps appends amortized."""
+        file_path = os.path.join(self.path, "features.npy")
+        grown_path = file_path + ".tmp"
+        grown = np.lib.format.open_memmap(grown_path, mode='w+', dtype=np.float32,
+                                          shape=(len(self.columns), capacity))
+        grown[:, :len(self.keys)] = self.data[:, :len(self.keys)]
+        grown.flush()
+        del grown
+        self.data = None  # Release the old mapping before replacing the file
+        os.replace(grown_path, file_path)
+        self.data = np.load(file_path, mmap_mode=self.mode)
+
+    def flush(self):
+        """Write pending features and the slice keys to disk."""
+        self.data.flush()
+        with open(os.path.join(self.path, "metadata.json"), "w") as f:
+            json.dump({"columns": self.columns, "keys": self.keys}, f)
+
+    def column(self, name):
+        """All the stored values of one feature, read straight from the mapping."""
+        return self.data[self.columns.index(name), :len(self.keys)]
+
+    def matrix(self):
+        """Features as an in-memory (slices, columns) array."""
+        return np.ascontiguousarray(self.data[:, :len(self.keys)].T)
+
+
+def extract_to_store(store, images, keys, levels=3, batch_size=256):
+    """
+    Extract the features of many slices in batches and append them to a store.
+    Only one batch is held in memory at a time, so `images` can be a memory-mapped stack.
+    """
+    if len(images) != len(keys):
+        raise ValueError("Need one key per image")
+    for start in range(0, len(keys), batch_size):
+        batch = np.asarray(images[start:start + batch_size])
+        store.append(keys[start:start + batch_size], extract_features(batch, levels))
+
+
+class SimilarityIndex:
+    """
+    Approximate nearest-neighbour index over feature vectors.
+
+    Features are standardized, then split into cells with k-means. A query is only
+    compared with the slices in the `probes` cells whose centres are closest to it,
+    instead of with every stored slice. A true neighbour that sits in a cell that was
+    not probed is missed, so results are approximate. Raising `probes` finds more of
+    the true neighbours at the cost of slower queries, and probes equal to the number
+    of cells gives an exact scan.
+
+    Attributes:
+        centroids: Centre of every cell in standardized feature space.
+        order: Slice indices sorted by cell.
+        offsets: order[offsets[i]:offsets[i + 1]] are the slices in cell i.
+        probes: Number of cells searched per query.
+    """
+
+    def __init__(self, features, cells=None, probes=8, iterations=10, seed=0):
+        features = np.asarray(features, dtype=np.float32)
+        count = features.shape[0]
+        if count == 0:
+            raise ValueError("Cannot index an empty feature set")
+
+        self.mean = features.mean(axis=0)
+        self.scale = features.std(axis=0)
+        self.scale[self.scale == 0] = 1.0
+        self.vectors = (features - self.mean) / self.scale
+
+        if cells is None:
+            cells = int(np.sqrt(count))
+        cells = max(1, min(cells, count))
+        self.probes = min(probes, cells)
+
+        rng = np.random.default_rng(seed)
+        self.centroids = self.vectors[rng.choice(count, cells, replace=False)]
+        for _ in range(iterations):
+            assignment = self._nearest_cells(self.vectors, 1)[:, 0]
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assignment, self.vectors)
+            sizes = np.bincount(assignment, minlength=cells)
+            filled = sizes > 0  # Empty cells keep their old centre
+            self.centroids[filled] = sums[filled] / sizes[filled, None]
+
+        assignment = self._nearest_cells(self.vectors, 1)[:, 0]
+        self.order = np.argsort(assignment, kind='stable')
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=cells))))
+
+    def _nearest_cells(self, vectors, n):
+        """Indices of the n closest centroids for every vector."""
+        distances = (np.sum(vectors ** 2, axis=1)[:, None] - 2 * vectors @ self.centroids.T
+                     + np.sum(self.centroids ** 2, axis=1)[None, :])
+        if n == 1:
+            return np.argmin(distances, axis=1)[:, None]
+        if n >= self.centroids.shape[0]:
+            return np.argsort(distances, axis=1)
+        return np.argpartition(distances, n - 1, axis=1)[:, :n]
+
+    def query(self, features, k=5):
+        """
+        Find approximately the k stored slices most similar to a feature vector.
+
+        Only the slices in the probed cells are compared, so some true neighbours can be
+        missed. Build the index with more `probes` for better recall. If the probed cells hold fewer than k slices, the number of probed cells is
+        doubled until they do, up to a scan of every cell, so the result has
+        min(k, number of indexed slices) entries.
+
+        Returns:
+            indices: Positions of the matches in the indexed features, closest first.
+            distances: Euclidean distances in standardized feature space.
+        """
+        vector = (np.asarray(features, dtype=np.float32) - self.mean) / self.scale
+        wanted = min(k, self.order.size)
+        probes = self.probes
+        while True:
+            cells = self._nearest_cells(vector[None], probes)[0]
+            candidates = np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in cells])
+            if candidates.size >= wanted or probes >= self.centroids.shape[0]:
+                break
+            probes = min(2 * probes, self.centroids.shape[0])
+
+        distances = np.sqrt(np.sum((self.vectors[candidates] - vector) ** 2, axis=1))
+        if k < candidates.size:
+            best = np.argpartition(distances, k)[:k]
+        else:
+            best = np.arange(candidates.size)
+        best = best[np.argsort(distances[best])]
+        return candidates[best], distances[best]
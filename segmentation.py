@@ -0,0 +1,366 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+class LabelMap:
+    """
+    Result of a segmentation, kept compact so whole volumes of it fit in memory.
+
+    Attributes:
+        labels: uint16 array with the image shape, 0 is background and 1..count are regions.
+        areas: Pixel count of every region, indexed by label - 1.
+        bboxes: (count, 4) array of (min_row, min_col, max_row, max_col), max values exclusive.
+    """
+
+    def __init__(self, labels, areas, bboxes):
+        self.labels = labels
+        self.areas = areas
+        self.bboxes = bboxes
+
+    @property
+    def count(self):
+        return self.areas.size
+
+
+def histogram(image, bins=256):
+    """
+    Build the intensity histogram of an image in a single pass.
+
+    uint8 images are counted directly, anything else is quantized into `bins`
+    equal steps between its min and max value. Bin k holds the values in
+    (values[k - 1], values[k]], so `image > values[k]` is exactly the pixels of the
+    bins above k and thresholds picked from the histogram split the image the same way.
+
+    Returns:
+        counts: Number of pixels in each bin.
+        values: Intensity represented by each bin.
+    """
+    image = np.asarray(image)
+    if image.dtype == np.uint8:
+        counts = np.bincount(image.ravel(), minlength=256)
+        return counts, np.arange(256, dtype=np.float64)
+
+    minval, maxval = float(image.min()), float(image.max())
+    if maxval == minval:
+        counts = np.zeros(bins, dtype=np.int64)
+        counts[0] = image.size
+        return counts, np.full(bins, minval)
+
+    step = (maxval - minval) / (bins - 1)
+    indices = np.clip(np.ceil((image - minval) / step), 0, bins - 1).astype(np.intp)
+    counts = np.bincount(indices.ravel(), minlength=bins)
+    return counts, minval + step * np.arange(bins)
+
+
+def otsu_threshold(image):
+    """
+    Find the threshold that maximizes the between-class variance of the image.
+    Pixels with a value greater than the threshold belong to the foreground.
+    """
+    counts, values = histogram(image)
+    p = counts / counts.sum()
+
+    weight = np.cumsum(p)  # Probability of the background class for every cut
+    mean = np.cumsum(p * values)
+    total_mean = mean[-1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variance = (total_mean * weight - mean) ** 2 / (weight * (1.0 - weight))
+    variance = np.nan_to_num(variance, nan=0.0, posinf=0.0)
+
+    return values[np.argmax(variance)]
+
+
+def multi_otsu_thresholds(image, classes=3):
+    """
+    Multi-level Otsu: split the histogram into `classes` classes with maximum between-class variance.
+
+    Every candidate class is scored from prefix sums of the histogram, and the best
+    set of cuts is found with dynamic programming over the bins instead of trying
+    every combination of thresholds.
+
+    Returns:
+        Increasing array of `classes - 1` thresholds, use `np.digitize(image, thresholds, right=True)`
+        to get the class of each pixel.
+    """
+    if classes < 2:
+        raise ValueError("At least two classes are needed")
+
+    counts, values = histogram(image)
+    n_bins = counts.size
+    if classes > n_bins:
+        raise ValueError("More classes than histogram bins")
+
+    p = counts / counts.sum()
+    weight = np.concatenate(([0.0], np.cumsum(p)))
+    mean = np.concatenate(([0.0], np.cumsum(p * values)))
+
+    # score[a, b] is the contribution of a class made of bins a..b-1
+    w = weight[None, :] - weight[:, None]
+    m = mean[None, :] - mean[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        score = np.where(w > 0, m ** 2 / w, 0.0)
+    start, end = np.indices(score.shape)
+    score[end <= start] = -np.inf  # Classes can not be empty ranges
+
+    best = score[0]
+    choices = []
+    for _ in range(classes - 1):
+        total = best[:, None] + score
+        choice = np.argmax(total, axis=0)
+        best = total[choice, np.arange(n_bins + 1)]
+        choices.append(choice)
+
+    # Walk back from the last bin to recover where each class starts
+    cuts = []
+    end = n_bins
+    for choice in reversed(choices):
+        end = choice[end]
+        cuts.append(end)
+    cuts.reverse()
+
+    return values[np.asarray(cuts) - 1]
+
+
+def _neighbour_pairs(shape, connectivity):
+    """Flat index pairs of every neighbouring pixel pair in an image of the given shape."""
+    rows, cols = shape
+    index = np.arange(rows * cols).reshape(rows, cols)
+    pairs = [
+        (index[:, :-1], index[:, 1:]),  # right
+        (index[:-1, :], index[1:, :]),  # down
+    ]
+    if connectivity == 2:
+        pairs.append((index[:-1, :-1], index[1:, 1:]))  # down-right
+        pairs.append((index[:-1, 1:], index[1:, :-1]))  # down-left
+    return pairs
+
+
+def _compress(parent):
+    """Point every node of the union-find forest straight at its root."""
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            return parent
+        parent = grandparent
+
+
+def label_components(mask, connectivity=1):
+    """
+    Label the connected regions of a binary mask.
+
+    Uses union-find over whole arrays of pixel pairs at once: every round hooks the
+    larger root of each unresolved pair onto the smaller one and compresses the paths,
+    until all neighbouring foreground pixels share a root.
+
+    Args:
+        mask: 2D boolean array, True marks the foreground.
+        connectivity: 1 for 4-connected regions, 2 for 8-connected regions.
+
+    Returns:
+        LabelMap with regions numbered in raster order of their first pixel.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    if mask.ndim != 2:
+        raise ValueError("Only 2D masks can be labelled")
+    if connectivity not in (1, 2):
+        raise ValueError("Connectivity must be 1 or 2")
+
+    flat_mask = mask.ravel()
+    first, second = [], []
+    for a, b in _neighbour_pairs(mask.shape, connectivity):
+        both = flat_mask[a] & flat_mask[b]
+        first.append(a[both])
+        second.append(b[both])
+    first = np.concatenate(first)
+    second = np.concatenate(second)
+
+    parent = np.arange(mask.size)
+    while first.size:
+        root_a = parent[first]
+        root_b = parent[second]
+        unresolved = root_a != root_b
+        if not unresolved.any():
+            break
+        first, second = first[unresolved], second[unresolved]
+        root_a, root_b = root_a[unresolved], root_b[unresolved]
+        np.minimum.at(parent, np.maximum(root_a, root_b), np.minimum(root_a, root_b))
+        parent = _compress(parent)
+
+    foreground = np.flatnonzero(flat_mask)
+    roots, relabelled = np.unique(parent[foreground], return_inverse=True)
+    if roots.size > np.iinfo(np.uint16).max:
+        raise ValueError("Too many regions to store in a uint16 label map")
+
+    labels = np.zeros(mask.size, dtype=np.uint16)
+    labels[foreground] = relabelled + 1
+    labels = labels.reshape(mask.shape)
+    return LabelMap(labels, *region_properties(labels, roots.size))
+
+
+def region_properties(labels, count):
+    """
+    Compute the area and bounding box of every region in a label image.
+
+    Returns:
+        areas: uint32 array with the pixel count of labels 1..count.
+        bboxes: int32 array of (min_row, min_col, max_row, max_col), max values exclusive.
+    """
+    areas = np.bincount(labels.ravel(), minlength=count + 1)[1:count + 1].astype(np.uint32)
+
+    rows, cols = np.nonzero(labels)
+    order = np.argsort(labels[rows, cols], kind='stable')  # Groups pixels by label, rows stay sorted
+    rows, cols = rows[order], cols[order]
+
+    bboxes = np.zeros((count, 4), dtype=np.int32)
+    present = areas > 0  # Multi-Otsu classes can be empty
+    sizes = areas[present].astype(np.intp)
+    if sizes.size:
+        starts = np.cumsum(sizes) - sizes
+        bboxes[present, 0] = rows[starts]
+        bboxes[present, 1] = np.minimum.reduceat(cols, starts)
+        bboxes[present, 2] = rows[starts + sizes - 1] + 1
+        bboxes[present, 3] = np.maximum.reduceat(cols, starts) + 1
+
+    return areas, bboxes
+
+
+def remove_small_regions(label_map, min_area):
+    """Drop regions smaller than `min_area` pixels and renumber the rest."""
+    keep = label_map.areas >= min_area
+    if keep.all():
+        return label_map
+
+    remap = np.zeros(label_map.count + 1, dtype=np.uint16)
+    remap[1:][keep] = np.arange(1, keep.sum() + 1)
+    return LabelMap(remap[label_map.labels], label_map.areas[keep], label_map.bboxes[keep])
+
+
+def region_grow(image, seed, tolerance, max_pixels=None, connectivity=1, max_rounds=10):
+    """
+    Grow a region from a seed pixel over neighbours close to the region's mean intensity.
+
+    Every round adds the pixels within `tolerance` of the current region mean to the
+    region, keeps the connected component holding the seed and updates the mean from
+    it, until the region stops growing or `max_rounds` is reached. Each round
+    is one call to label_components, so the cost depends on the image size and not on
+    how long or winding the region is.
+
+    Args:
+        image: 2D array of intensities.
+        seed: (row, col) of the starting pixel.
+        tolerance: Largest allowed difference between a pixel and the region mean.
+        max_pixels: Largest region size, the pixels closest to the seed are kept. Whole image if None.
+        connectivity: 1 for 4-connected growth, 2 for 8-connected growth.
+        max_rounds: Largest number of mean updates.
+
+    Returns:
+        Boolean mask of the grown region.
+    """
+    image = np.asarray(image, dtype=np.float64)
+    rows, cols = image.shape
+    row, col = seed
+    if not (0 <= row < rows and 0 <= col < cols):
+        raise ValueError("Seed is outside the image")
+    if max_pixels is not None and max_pixels < 1:
+        raise ValueError("max_pixels must be at least 1")
+    if not tolerance >= 0:
+        raise ValueError("tolerance must be zero or positive")
+    if max_rounds < 1:
+        raise ValueError("max_rounds must be at least 1")
+
+    region = np.zeros(image.shape, dtype=bool)
+    region[row, col] = True
+    region_mean = image[row, col]
+    for _ in range(max_rounds):
+        # The region never shrinks, so rounds can not flip between two answers
+        mask = (np.abs(image - region_mean) <= tolerance) | region
+        labels = label_components(mask, connectivity).labels
+        grown = labels == labels[row, col]
+        if np.array_equal(grown, region):
+            break
+        region = grown
+        region_mean = image[region].mean()
+
+    if max_pixels is not None and region.sum() > max_pixels:
+        # Keep the k pixels closest to the seed, with the largest k whose seed component fits
+        region_rows, region_cols = np.nonzero(region)
+        order = np.argsort((region_rows - row) ** 2 + (region_cols - col) ** 2, kind='stable')
+        region_rows, region_cols = region_rows[order], region_cols[order]
+
+        def seed_component(k):
+            trimmed = np.zeros_like(region)
+            trimmed[region_rows[:k], region_cols[:k]] = True
+            labels = label_components(trimmed, connectivity).labels
+            return labels == labels[row, col]
+
+        low, high = max_pixels, region_rows.size  # The seed component of the low closest pixels always fits
+        while low < high:
+            middle = (low + high + 1) // 2
+            if seed_component(middle).sum() <= max_pixels:
+                low = middle
+            else:
+                high = middle - 1
+        region = seed_component(low)
+
+    return region
+
+
+def segment_image(image, method="otsu", classes=3, seed=None, tolerance=None, min_area=0, connectivity=1):
+    """
+    Segment a single slice into labelled regions.
+
+    Args:
+        image: 2D array, usually the uint8 grayscale slice.
+        method: "otsu" labels the connected regions brighter than the Otsu threshold,
+            "multiotsu" labels every pixel with its intensity class (1..classes),
+            "region" grows a single region from `seed`.
+        classes: Number of classes for "multiotsu".
+        seed: (row, col) of the starting pixel for "region".
+        tolerance: Intensity tolerance for "region", 10% of the image range if None.
+        min_area: Regions with fewer pixels are dropped.
+        connectivity: 1 for 4-connected regions, 2 for 8-connected regions.
+
+    Returns:
+        LabelMap of the slice.
+    """
+    image = np.asarray(image)
+
+    if method == "otsu":
+        label_map = label_components(image > otsu_threshold(image), connectivity)
+    elif method == "multiotsu":
+        thresholds = multi_otsu_thresholds(image, classes)
+        labels = (np.digitize(image, thresholds, right=True) + 1).astype(np.uint16)
+        label_map = LabelMap(labels, *region_properties(labels, classes))
+    elif method == "region":
+        if seed is None:
+            raise ValueError("Region growing needs a seed pixel")
+        if tolerance is None:
+            tolerance = 0.1 * (float(image.max()) - float(image.min()))
+        mask = region_grow(image, seed, tolerance, connectivity=connectivity)
+        label_map = label_components(mask, connectivity)
+    else:
+        raise ValueError(f"Unknown segmentation method: {method}")
+
+    if min_area > 0:
+        label_map = remove_small_regions(label_map, min_area)
+    return label_map
+
+
+def segment_volume(volume, workers=None, **kwargs):
+    """
+    Segment a stack of slices in parallel, one slice per task.
+
+    numpy releases the GIL inside the heavy array operations, so a thread pool is
+    enough and the slices never need to be copied into other processes.
+
+    Args:
+        volume: 3D array (slices, rows, cols) or any sequence of 2D slices.
+        workers: Number of threads, chosen by ThreadPoolExecutor if None.
+        **kwargs: Passed on to segment_image for every slice.
+
+    Returns:
+        List with the LabelMap of every slice.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda image: segment_image(image, **kwargs), volume))
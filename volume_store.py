@@ -0,0 +1,317 @@
+import os
+import json
+import zlib
+import threading
+import itertools
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ChunkedArray:
+    """
+    One array of a ChunkedStore, split into fixed-size chunks stored as separate files.
+
+    Chunks are either zlib-compressed (compression="zlib") or plain .npy files
+    (compression=None). Reads only open the chunks that overlap the requested range,
+    and uncompressed chunks are memory-mapped so only the touched bytes are loaded.
+    Chunks that were never written read as zeros.
+
+    Attributes:
+        path: Directory holding the chunk files.
+        shape, dtype: Shape and dtype of the whole array.
+        chunks: Shape of one chunk, edge chunks are cut to the array shape.
+        compression: "zlib" or None.
+        attrs: Free-form metadata saved with the array.
+    """
+
+    def __init__(self, path, shape, dtype, chunks, compression, compression_level, attrs):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.chunks = tuple(chunks)
+        self.compression = compression
+        self.compression_level = compression_level
+        self.attrs = attrs
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def _chunk_path(self, index):
+        suffix = ".npy" if self.compression is None else ".z"
+        return os.path.join(self.path, "c." + ".".join(map(str, index)) + suffix)
+
+    def _chunk_shape(self, index):
+        return tuple(min(c, s - i * c) for i, c, s in zip(index, self.chunks, self.shape))
+
+    def _read_chunk(self, index):
+        path = self._chunk_path(index)
+        shape = self._chunk_shape(index)
+        if not os.path.exists(path):
+            return np.zeros(shape, dtype=self.dtype)
+        if self.compression is None:
+            return np.load(path, mmap_mode='r')
+        with open(path, "rb") as f:
+            return np.frombuffer(zlib.decompress(f.read()), dtype=self.dtype).reshape(shape)
+
+    def _write_chunk(self, index, data):
+        """Write a whole chunk through a temporary file, so readers never see half a chunk."""
+        path = self._chunk_path(index)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        data = np.ascontiguousarray(data, dtype=self.dtype)
+        with open(temp_path, "wb") as f:
+            if self.compression is None:
+                np.save(f, data)
+            else:
+                f.write(zlib.compress(data.tobytes(), self.compression_level))
+        os.replace(temp_path, path)
+
+    def _overlapping_chunks(self, bounds):
+        """Chunk indices touched by a region given as (start, stop) per dimension."""
+        ranges = [range(start // c, -(-stop // c)) for (start, stop), c in zip(bounds, self.chunks)]
+        return itertools.product(*ranges)
+
+    def read(self, bounds):
+        """
+        Read a region of the array.
+
+        Args:
+            bounds: (start, stop) for every dimension.
+
+        Returns:
+            In-memory array with the region.
+        """
+        out = np.zeros([stop - start for start, stop in bounds], dtype=self.dtype)
+        for index in self._overlapping_chunks(bounds):
+            chunk = self._read_chunk(index)
+            src, dst = [], []
+            for i, c, (start, stop), size in zip(index, self.chunks, bounds, chunk.shape):
+                lo = max(start, i * c)
+                hi = min(stop, i * c + size)
+                src.append(slice(lo - i * c, hi - i * c))
+                dst.append(slice(lo - start, hi - start))
+            out[tuple(dst)] = chunk[tuple(src)]
+        return out
+
+    def write(self, data, offset=None):
+        """
+        Write `data` into the array starting at `offset` (zeros by default).
+
+        Chunks fully covered by `data` are written directly. Partly covered chunks are read,
+        updated and written back, so workers writing in parallel should use regions
+        aligned to the chunk grid, which makes every chunk belong to a single worker.
+        """
+        data = np.asarray(data)
+        if data.ndim != self.ndim:
+            raise ValueError(f"Expected {self.ndim} dimensions, got {data.ndim}")
+        offset = (0,) * self.ndim if offset is None else tuple(offset)
+        bounds = [(o, o + n) for o, n in zip(offset, data.shape)]
+        if any(start < 0 or stop > size for (start, stop), size in zip(bounds, self.shape)):
+            raise ValueError("Data does not fit in the array at this offset")
+
+        for index in self._overlapping_chunks(bounds):
+            chunk_shape = self._chunk_shape(index)
+            src, dst = [], []
+            for i, c, (start, stop), size in zip(index, self.chunks, bounds, chunk_shape):
+                lo = max(start, i * c)
+                hi = min(stop, i * c + size)
+                src.append(slice(lo - start, hi - start))
+                dst.append(slice(lo - i * c, hi - i * c))
+
+            if all(s.stop - s.start == size for s, size in zip(dst, chunk_shape)):
+                chunk = data[tuple(src)]
+            else:
+                chunk = np.array(self._read_chunk(index))
+                chunk[tuple(dst)] = data[tuple(src)]
+            self._write_chunk(index, chunk)
+
+    def __getitem__(self, key):
+        """Partial reads with integers and contiguous slices, e.g. array[10:20, 100:200, 50:150]."""
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > self.ndim:
+            raise IndexError("Too many indices")
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        bounds, post = [], []
+        for k, size in zip(key, self.shape):
+            if isinstance(k, (int, np.integer)):
+                i = k + size if k < 0 else k
+                if not 0 <= i < size:
+                    raise IndexError(f"Index {k} is out of range for size {size}")
+                bounds.append((i, i + 1))
+                post.append(0)
+            elif isinstance(k, slice):
+                start, stop, step = k.indices(size)
+                if step != 1:
+                    raise IndexError("Only contiguous slices are supported")
+                bounds.append((start, max(start, stop)))
+                post.append(slice(None))
+            else:
+                raise TypeError(f"Unsupported index: {k!r}")
+
+        return self.read(bounds)[tuple(post)]
+
+
+class ChunkedStore:
+    """
+    Directory of chunked arrays with their metadata, for processed MRI stacks.
+
+    Layout: store.json describes every array, and every array has its own
+    subdirectory of chunk files. Array metadata is written when the array is created,
+    after that workers can open the store and write chunks on their own.
+
+    Attributes:
+        path: Root directory of the store.
+        attrs: Metadata of the whole store, e.g. the study it came from.
+    """
+
+    def __init__(self, path):
+        """Open an existing store."""
+        self.path = path
+        with open(os.path.join(path, "store.json")) as f:
+            metadata = json.load(f)
+        self.attrs = metadata["attrs"]
+        self._arrays = {name: self._open_array(name, info) for name, info in metadata["arrays"].items()}
+
+    @classmethod
+    def create(cls, path, attrs=None):
+        """Create an empty store, refusing to overwrite an existing one."""
+        if os.path.exists(os.path.join(path, "store.json")):
+            raise FileExistsError(f"A store already exists at {path}")
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "store.json"), "w") as f:
+            json.dump({"attrs": attrs or {}, "arrays": {}}, f, indent=2)
+        return cls(path)
+
+    def _open_array(self, name, info):
+        return ChunkedArray(os.path.join(self.path, name), info["shape"], info["dtype"], info["chunks"],
+                            info["compression"], info["compression_level"], info["attrs"])
+
+    def _save_metadata(self):
+        arrays = {
+            name: {
+                "shape": list(array.shape),
+                "dtype": array.dtype.str,
+                "chunks": list(array.chunks),
+                "compression": array.compression,
+                "compression_level": array.compression_level,
+                "attrs": array.attrs,
+            }
+            for name, array in self._arrays.items()
+        }
+        with open(os.path.join(self.path, "store.json"), "w") as f:
+            json.dump({"attrs": self.attrs, "arrays": arrays}, f, indent=2)
+
+    def create_array(self, name, shape, dtype, chunks=None, compression="zlib", compression_level=1, attrs=None):
+        """
+        Add an empty array to the store.
+
+        Args:
+            name: Name of the array, also used as its directory name.
+            shape, dtype: Shape and dtype of the whole array, e.g. (slices, rows, cols).
+            chunks: Shape of one chunk, by default 8 slices of 128x128 pixels.
+            compression: "zlib" to compress chunks, None to keep them memory-mappable.
+            compression_level: zlib level, 1 is the fastest.
+            attrs: Free-form JSON-serializable metadata.
+        """
+        if not isinstance(name, str) or name in ("", ".", "..", "store.json") or "/" in name or os.sep in name:
+            raise ValueError(f"Invalid array name: {name!r}")
+        if name in self._arrays:
+            raise ValueError(f"Array {name} already exists")
+        if compression not in ("zlib", None):
+            raise ValueError(f"Unknown compression: {compression}")
+        if chunks is None:
+            chunks = (8,) + (128,) * (len(shape) - 1)
+        chunks = tuple(max(1, min(c, s)) for c, s in zip(chunks, shape))
+
+        array_path = os.path.join(self.path, name)
+        os.makedirs(array_path, exist_ok=True)
+        for file_name in os.listdir(array_path):
+            if file_name.startswith("c."):
+                os.remove(os.path.join(array_path, file_name))  # Leftover chunks would read as data of the new array
+        self._arrays[name] = ChunkedArray(array_path, shape, np.dtype(dtype).str, chunks,
+                                          compression, compression_level, attrs or {})
+        self._save_metadata()
+        return self._arrays[name]
+
+    def __getitem__(self, name):
+        return self._arrays[name]
+
+    def __contains__(self, name):
+        return name in self._arrays
+
+    @property
+    def names(self):
+        return list(self._arrays)
+
+    def write_parallel(self, name, data, start=0, workers=None):
+        """
+        Write a stack of slices starting at slice `start` with a pool of threads.
+
+        The stack is split into blocks along the chunk grid of the first axis, so each
+        block owns its chunks. zlib releases the GIL while compressing, so the threads
+        compress in parallel.
+        """
+        array = self._arrays[name]
+        step = array.chunks[0]
+        end = start + len(data)
+        edges = [start] + list(range((start // step + 1) * step, end, step)) + [end]
+
+        def write_block(bounds):
+            lo, hi = bounds
+            offset = (lo,) + (0,) * (array.ndim - 1)
+            array.write(data[lo - start:hi - start], offset)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(write_block, zip(edges[:-1], edges[1:])))
+
+
+def split_haar_subbands(transformed):
+    """
+    Split Haar transformed slices into LL, LH, HL and HH, the same way Main_UI.plot_haar_subbands does.
+    Works on a single slice (rows, cols) or a stack (slices, rows, cols).
+    """
+    rows, cols = transformed.shape[-2:]
+    return {
+        "LL": transformed[..., :rows // 2, :cols // 2],
+        "LH": transformed[..., :rows // 2, cols // 2:],
+        "HL": transformed[..., rows // 2:, :cols // 2],
+        "HH": transformed[..., rows // 2:, cols // 2:],
+    }
+
+
+def save_study(path, original, upscaled=None, reconstructed=None, transformed=None, attrs=None, workers=None,
+               chunks=None, compression="zlib", subband_compression=None):
+    """
+    Save the processed stacks of a study as separate chunked arrays.
+
+    Args:
+        path: Directory of the new store, it must not hold a store already.
+        original: Original slices (slices, rows, cols).
+        upscaled: Bicubic upscaled slices.
+        reconstructed: Slices reconstructed with the inverse Haar transform.
+        transformed: Haar transformed slices, stored as LL, LH, HL and HH arrays.
+        attrs: Metadata of the study.
+        workers: Number of writer threads.
+        chunks: Chunk shape of every array, see ChunkedStore.create_array.
+        compression: Compression of the original, upscaled and reconstructed arrays.
+        subband_compression: Compression of the subband arrays. None by default, float
+            subbands barely compress and uncompressed chunks are memory-mapped on read.
+
+    Returns:
+        The ChunkedStore.
+    """
+    store = ChunkedStore.create(path, attrs)
+    stacks = {"original": original, "upscaled": upscaled, "reconstructed": reconstructed}
+    subbands = split_haar_subbands(np.asarray(transformed)) if transformed is not None else {}
+    stacks.update(subbands)
+
+    for name, stack in stacks.items():
+        if stack is None:
+            continue
+        stack = np.asarray(stack)
+        store.create_array(name, stack.shape, stack.dtype, chunks=chunks,
+                           compression=subband_compression if name in subbands else compression)
+        store.write_parallel(name, stack, workers=workers)
+    return store